@@ -0,0 +1,344 @@
+import collections
+import csv
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import config
+import utils
+
+
+# A single series to convert: inputs and outputs are files or DICOM directories.
+# The conversion function is called with args followed by a temporary path per
+# output, moved into place once it succeeds, and recursive as a keyword.
+# Input directories include the DICOMs in their sub-directories if recursive,
+# as for manifest rows, while discovered series are only the DICOMs directly
+# in their directory. Output directories never include sub-directories.
+BatchTask = collections.namedtuple('BatchTask', 'name inputs outputs args recursive')
+
+
+def read_manifest(path, columns: int) -> list:
+    '''Read a CSV manifest with one series per row.
+
+    Empty rows and rows starting with # are ignored.
+
+    :param path: the path to the manifest
+    :param columns: the number of columns expected per row
+    :return: a list of rows, each a list of strings
+    '''
+    with open(str(path), newline='') as manifest_file:
+        rows = [[col.strip() for col in row] for row in csv.reader(manifest_file)
+                if row and not row[0].strip().startswith('#')]
+
+    for line, row in enumerate(rows, 1):
+        if len(row) != columns:
+            raise ValueError('Manifest row %d has %d columns, expected %d' % (line, len(row), columns))
+    return rows
+
+
+def load_checksums(report_path) -> dict:
+    '''Read the input checksums of a previous batch report.
+
+    :param report_path: the path to the previous report
+    :return: dict, series name to the checksum of its inputs
+    '''
+    if not os.path.isfile(str(report_path)):
+        return {}
+
+    with open(str(report_path)) as report_file:
+        report = json.load(report_file)
+    return {result['name']: result['checksum'] for result in report['series']
+            if result['status'] != 'failed' and result.get('checksum')}
+
+
+def _expand(paths, recursive: bool = False) -> list:
+    '''Expand directories into the DICOMs in them'''
+    return [f for path in paths for f in utils.get_files(Path(path), config.DCM2HD5_INPUT_EXT, recursive)]
+
+
+def _checksum(files) -> str:
+    sha = hashlib.sha256()
+    for path in sorted(files):
+        sha.update(str(path).encode())
+        with open(str(path), 'rb') as in_file:
+            for block in iter(lambda: in_file.read(config.BATCH_CHECKSUM_BLOCK), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def _output_files(task: BatchTask) -> list:
+    '''Get the files of every output, empty if any output is missing'''
+    output_files = []
+    for path in task.outputs:
+        files = _expand([path]) if Path(path).exists() else []
+        if not files:
+            return []
+        output_files.extend(files)
+    return output_files
+
+
+def _staged_path(path) -> str:
+    '''Temporary sibling of an output, dot-prefixed so discover_series skips it'''
+    path = Path(path)
+    return str(path.parent / ('.' + path.name + config.BATCH_STAGED_SUFFIX))
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _commit_output(staged, path):
+    '''Move a staged output into place, file by file for directories so the
+    sub-directory series of an output directory are kept'''
+    if os.path.isdir(staged):
+        os.makedirs(str(path), exist_ok=True)
+        for name in os.listdir(staged):
+            os.replace(os.path.join(staged, name), os.path.join(str(path), name))
+        os.rmdir(staged)
+    else:
+        os.replace(staged, str(path))
+
+
+def _run_task(convert, task: BatchTask, use_checksum: bool, prev_checksum) -> dict:
+    '''Convert a single series in a worker, catching any error it raises'''
+    start = time.time()
+    result = {'name': task.name, 'status': 'converted', 'seconds': 0.0, 'error': None, 'checksum': None}
+    try:
+        input_files = _expand(task.inputs, task.recursive)
+        if not input_files:
+            raise FileNotFoundError('No input files found for %s' % (task.name,))
+
+        if use_checksum:
+            result['checksum'] = _checksum(input_files)
+
+        # Outputs are up to date if they exist and match the checksum, or aren't older than the inputs
+        output_files = _output_files(task)
+        if not output_files:
+            up_to_date = False
+        elif use_checksum:
+            up_to_date = result['checksum'] == prev_checksum
+        else:
+            newest_input = max(os.path.getmtime(str(f)) for f in input_files)
+            up_to_date = min(os.path.getmtime(str(f)) for f in output_files) >= newest_input
+
+        if up_to_date:
+            result['status'] = 'skipped'
+        else:
+            # Write to staged outputs, so a series dying mid-write never looks up to date
+            staged = [_staged_path(path) for path in task.outputs]
+            for path in staged:
+                os.makedirs(str(Path(path).parent), exist_ok=True)
+                _remove(path)
+            try:
+                convert(*task.args, *staged, recursive=task.recursive)
+            except Exception:
+                for path in staged:
+                    _remove(path)
+                raise
+
+            for staged_path, path in zip(staged, task.outputs):
+                _commit_output(staged_path, path)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+
+    result['seconds'] = time.time() - start
+    return result
+
+
+def _run_pool(convert, pending: list, results: list, workers: int, use_checksum: bool, prev_checksums: dict) -> list:
+    '''Run pending tasks across a process pool until it's done or a worker dies.
+
+    At most workers tasks are in flight, so a dead worker only leaves those
+    tasks unaccounted for.
+
+    :return: the tasks in flight when the pool broke
+    '''
+    in_flight = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or in_flight:
+            while pending and len(in_flight) < workers:
+                task = pending.pop()
+                future = pool.submit(_run_task, convert, task, use_checksum, prev_checksums.get(task.name))
+                in_flight[future] = task
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = []
+            for future in done:
+                task = in_flight.pop(future)
+                try:
+                    results.append(future.result())
+                except BrokenProcessPool:
+                    broken.append(task)
+
+            if broken:
+                return broken + list(in_flight.values())
+    return []
+
+
+def run_batch(convert, tasks: list, workers: int = None, use_checksum: bool = False, prev_checksums: dict = None) -> list:
+    '''Convert many series across a process pool.
+
+    Errors raised by a series are recorded in its result. If a worker process
+    dies, the series that were in flight are retried one by one in their own
+    process, so only the one responsible is marked as failed.
+
+    :param convert: a picklable function called with the args of each task
+    :param tasks: a list of BatchTask objects
+    :param workers: the number of worker processes, defaults to the CPU count
+    :param use_checksum: compare input checksums instead of modification times
+    :param prev_checksums: dict, series name to the checksum of its last conversion
+    :return: a list of dicts, the result of each series
+    '''
+    logger = logging.getLogger(config.APP_NAME)
+    workers = workers or os.cpu_count()
+    prev_checksums = prev_checksums or {}
+    pending = list(reversed(tasks))
+    results = []
+
+    while pending:
+        suspects = _run_pool(convert, pending, results, workers, use_checksum, prev_checksums)
+        if suspects:
+            logger.warning('Worker process died, retrying %d series in isolation' % len(suspects))
+
+        for task in suspects:
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                future = pool.submit(_run_task, convert, task, use_checksum, prev_checksums.get(task.name))
+                try:
+                    results.append(future.result())
+                except BrokenProcessPool:
+                    results.append({'name': task.name, 'status': 'failed', 'seconds': 0.0,
+                                    'error': 'Worker process died', 'checksum': None})
+
+    for result in results:
+        if result['status'] == 'failed':
+            logger.error('Failed converting %s: %s' % (result['name'], result['error']))
+    return results
+
+
+def save_report(results: list, report_path, total_seconds: float) -> dict:
+    '''Write a JSON summary of a batch with per series timings and failures.
+
+    :param results: a list of dicts as returned by run_batch
+    :param report_path: the path to write the report to
+    :param total_seconds: the wall time of the whole batch
+    :return: dict, the number of series per status
+    '''
+    counts = collections.Counter(result['status'] for result in results)
+    report = {'total_seconds': total_seconds, 'counts': dict(counts),
+              'series': sorted(results, key=lambda result: result['name'])}
+
+    with open(str(report_path), 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    return counts
+
+
+def add_batch_arguments(parser, mode, batch_extn, report_file):
+    '''Add the batch mode arguments shared by the command line interfaces
+
+    :param parser: the argparse.ArgumentParser to extend
+    :param mode: the mutually exclusive group of the single series input, for --manifest and --batch-dir
+    :param batch_extn: Collection of input extensions found in --batch-dir
+    :param report_file: the default path to the batch summary report
+    '''
+    batch = parser.add_argument_group('batch mode')
+    mode.add_argument('--manifest', '-m', type=utils.existing_path(config.BATCH_MANIFEST_EXT, True),
+                       help='Path to a CSV manifest with one series per row')
+    mode.add_argument('--batch-dir', '-b', type=utils.existing_path(batch_extn), help='Path to a directory of series')
+    batch.add_argument('--output-dir', help='Path to the output directory for --batch-dir')
+    batch.add_argument('--workers', '-w', type=utils.positive_int, default=config.BATCH_WORKERS,
+                       help='Number of worker processes, defaults to the CPU count')
+    batch.add_argument('--checksum', action='store_true',
+                       help='Skip series whose input checksum matches the previous report instead of using mtimes')
+    batch.add_argument('--report', '-r', default=report_file, help='Path to the batch summary report')
+
+
+def visible_files(batch_dir: Path, supported_extn) -> list:
+    '''Get all files under batch_dir, except those under a dot-prefixed path
+    such as the staged outputs left behind by a dead worker.
+
+    :param batch_dir: the directory to search
+    :param supported_extn: Collection of supported extensions
+    :return: a list of the files found
+    '''
+    return [path for path in utils.get_files(batch_dir, supported_extn)
+            if not any(part.startswith('.') for part in path.relative_to(batch_dir).parts)]
+
+
+def discover_series(batch_dir: Path) -> list:
+    '''Find every directory under batch_dir holding DICOMs directly.
+
+    :param batch_dir: the directory to search
+    :return: a sorted list of the series directories
+    '''
+    return sorted({path.parent for path in visible_files(batch_dir, config.DCM2HD5_INPUT_EXT)})
+
+
+def series_name(path: Path, root: Path) -> str:
+    '''Name a series by its path relative to the batch directory.
+
+    Names keep the directory structure, e.g. nested/s3, so outputs of one
+    batch mode resolve back to their inputs in the other. A series directly in
+    root is named after root, which can collide with a sub-directory of the
+    same name, see check_unique.
+    '''
+    return path.relative_to(root).as_posix() if path != root else root.name
+
+
+def series_path(root: Path, name: str) -> Path:
+    '''Resolve a series name from series_name back to its path under root.
+
+    A name matching both root and a sub-directory of it is ambiguous, and raises a ValueError.
+    '''
+    root = Path(root)
+    path = root / name
+    if name != root.name:
+        return path
+    elif not path.exists():
+        return root
+    elif root.is_dir() and utils.get_files(root, config.DCM2HD5_INPUT_EXT, False):
+        raise ValueError('Series %s is ambiguous, it matches both %s and %s' % (name, root, path))
+    return path
+
+
+def check_unique(tasks: list):
+    '''Reject a batch with series sharing a name or an output, which would
+    overwrite each other.
+
+    :param tasks: a list of BatchTask objects
+    '''
+    names, outputs = set(), {}
+    for task in tasks:
+        if task.name in names:
+            raise ValueError('More than one series is named %s' % (task.name,))
+        names.add(task.name)
+
+        for path in task.outputs:
+            path = os.path.normpath(str(path))
+            if path in outputs:
+                raise ValueError('Series %s and %s both write to %s' % (outputs[path], task.name, path))
+            outputs[path] = task.name
+
+
+def main(convert, tasks: list, args):
+    '''Run a batch from parsed command line arguments and write its report'''
+    logger = logging.getLogger(config.APP_NAME)
+    logger.info('Starting batch of %d series' % len(tasks))
+
+    start = time.time()
+    prev_checksums = load_checksums(args.report) if args.checksum else {}
+    results = run_batch(convert, tasks, args.workers, args.checksum, prev_checksums)
+    counts = save_report(results, args.report, time.time() - start)
+
+    for status in ('converted', 'skipped', 'failed'):
+        print(config.OUTPUT_FORMAT % (status, counts[status]))
+    return counts
@@ -17,3 +17,22 @@ OUTPUT_FORMAT = '%s\t%d'
 
 WEB_OUTPUT_DIR = 'web-out'
 
+# Fraction of web jobs profiled even when not requested, 0 disables sampling.
+# Sampled jobs are only profiled when no other job is running, but while one is
+# profiled new jobs wait for it to finish, which can take as long as the job.
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_DIR_SUFFIX = '-profile'
+PROFILE_STATS_FILE = 'job.pstats'
+PROFILE_ALLOC_FILE = 'allocations.txt'
+PROFILE_TRACEMALLOC_FRAMES = 1
+PROFILE_TOP_ALLOCS = 10
+PROFILE_TOP_FUNCS = 25
+
+# Each batch mode keeps its own report, as --checksum compares against the previous one
+DCM2HD5_REPORT_FILE = 'dicom_to_hd5_report.json'
+HD52DCM_REPORT_FILE = 'hd5_to_dicom_report.json'
+BATCH_MANIFEST_EXT = ('.csv', '.CSV')
+# Worker processes for batch conversion, None uses the CPU count
+BATCH_WORKERS = None
+BATCH_CHECKSUM_BLOCK = 1 << 20
+BATCH_STAGED_SUFFIX = '.tmp'
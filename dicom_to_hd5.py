@@ -4,6 +4,7 @@ Main file for running the application
 """
 
 import argparse
+import batch
 import config
 import utils
 from pydicom.filereader import dcmread
@@ -11,6 +12,9 @@ import numpy as np
 import h5py
 import json
 import logging
+from pathlib import Path
+
+logger = logging.getLogger(config.APP_NAME)
 
 
 def construct_volume(dcms):
@@ -64,7 +68,7 @@ def save_record(volume, attribs, path_hdf5, path_json):
         json.dump(attribs, json_file)
 
 
-def dicom_to_hd5(input_dicom, output_hdf5 = None , output_json = None, save_records = True):
+def dicom_to_hd5(input_dicom, output_hdf5 = None , output_json = None, save_records = True, recursive = True):
     """ Construct a 3D volume from the dicoms present in the path and
     save the pixel data to a HDf5 and attributes to a json.
 
@@ -76,13 +80,15 @@ def dicom_to_hd5(input_dicom, output_hdf5 = None , output_json = None, save_reco
             Path to create output HDF5
     output_json:
             Path to create output JSON
+    recursive: bool
+            If DICOMs in sub-directories of input_dicom are included
 
     """
 
     logger = logging.getLogger(config.APP_NAME)
 
     logger.info("Retrieving DICOMS")
-    dcm_paths = utils.get_files(input_dicom, config.DCM2HD5_INPUT_EXT)
+    dcm_paths = utils.get_files(input_dicom, config.DCM2HD5_INPUT_EXT, recursive)
     dcms = [dcmread(str(path)) for path in dcm_paths]
     logger.info("Got %d DICOMS" % len(dcms))
 
@@ -98,17 +104,70 @@ def dicom_to_hd5(input_dicom, output_hdf5 = None , output_json = None, save_reco
     return volume, attributes
 
 
+def batch_tasks(manifest=None, batch_dir=None, output_dir=None):
+    """ Build the batch of series to convert, either from a manifest with
+    input_dicom,output_hdf5,output_json rows or from every directory containing
+    DICOMs under batch_dir. Manifest rows are read like the single series
+    arguments, including sub-directories. A discovered series is made of the
+    DICOMs directly in its directory, sub-directories are their own series.
+
+    Raises a ValueError if series collide, e.g. a series directly in batch_dir
+    and a sub-directory named after batch_dir.
+
+    Parameters
+    --------
+    manifest: Path
+            Path to the CSV manifest
+    batch_dir: Path
+            Path to a directory of DICOM series
+    output_dir: str
+            Path to the output directory for batch_dir, with the directory structure of batch_dir
+
+    """
+    if manifest:
+        tasks = [batch.BatchTask(name=in_dicom, inputs=[in_dicom], outputs=[out_hdf5, out_json],
+                                 args=(Path(in_dicom),), recursive=True)
+                 for in_dicom, out_hdf5, out_json in batch.read_manifest(manifest, 3)]
+        batch.check_unique(tasks)
+        return tasks
+
+    tasks = []
+    for series_dir in batch.discover_series(batch_dir):
+        name = batch.series_name(series_dir, batch_dir)
+        out_hdf5 = str(Path(output_dir) / (name + config.HD5_INPUT_EXT[0]))
+        out_json = str(Path(output_dir) / (name + '.json'))
+        tasks.append(batch.BatchTask(name=name, inputs=[str(series_dir)], outputs=[out_hdf5, out_json],
+                                     args=(series_dir,), recursive=False))
+    batch.check_unique(tasks)
+    return tasks
+
+
 if __name__ == '__main__':
     # Parse Arguments
     parser = argparse.ArgumentParser(description='Convert DICOMs to HD5 and JSON', add_help=False)
-    parser.add_argument('--input-dicom', '-i', required=True, type=utils.existing_path(config.DCM2HD5_INPUT_EXT),
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--input-dicom', '-i', type=utils.existing_path(config.DCM2HD5_INPUT_EXT),
                         help='Path to DICOM/s')
-    parser.add_argument('--output-hdf5', '-h', required=True, help='Path to output HD5')
-    parser.add_argument('--output-json', '-j', required=True, help='Path to output JSON')
+    parser.add_argument('--output-hdf5', '-h', help='Path to output HD5')
+    parser.add_argument('--output-json', '-j', help='Path to output JSON')
+    batch.add_batch_arguments(parser, mode, config.DCM2HD5_INPUT_EXT, config.DCM2HD5_REPORT_FILE)
     args = parser.parse_args()
 
+    is_batch = args.manifest or args.batch_dir
+    if is_batch and args.batch_dir and not args.output_dir:
+        parser.error('--output-dir is required with --batch-dir')
+    elif not is_batch and not (args.input_dicom and args.output_hdf5 and args.output_json):
+        parser.error('--input-dicom, --output-hdf5 and --output-json are required outside batch mode')
+
     # App Specific Logger
     logger = utils.init_logger()
 
     # Main app logic
-    dicom_to_hd5(args.input_dicom, args.output_hdf5, args.output_json)
\ No newline at end of file
+    if is_batch:
+        try:
+            tasks = batch_tasks(args.manifest, args.batch_dir, args.output_dir)
+        except ValueError as e:
+            parser.error(str(e))
+        batch.main(dicom_to_hd5, tasks, args)
+    else:
+        dicom_to_hd5(args.input_dicom, args.output_hdf5, args.output_json)
\ No newline at end of file
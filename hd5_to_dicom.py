@@ -4,6 +4,7 @@ Main file for running the application
 """
 
 import argparse
+import batch
 import config
 import utils
 from pydicom.filereader import dcmread
@@ -13,6 +14,9 @@ import h5py
 import json
 import os
 import logging
+from pathlib import Path
+
+logger = logging.getLogger(config.APP_NAME)
 
 def construct_volume(dcms):
     """ Construct 3D volume from the dicoms, slices arranged by slice location.
@@ -95,7 +99,7 @@ def split_volume_to_dcms(volume, template_dcms):
         dcm.SOPInstanceUID = generate_uid()
 
 
-def hd5_to_dicom(input_hdf5, input_dicom, output_dicom):
+def hd5_to_dicom(input_hdf5, input_dicom, output_dicom, recursive=True):
     """ Export pixel data from hdf5 to DICOMs images based on template DICOMs.
 
     Parameters
@@ -106,13 +110,15 @@ def hd5_to_dicom(input_hdf5, input_dicom, output_dicom):
             Path to a/many template DICOMs
     output_dicom: str
             Path to output DICOM directory
+    recursive: bool
+            If template DICOMs in sub-directories of input_dicom are included
 
     """
 
     logger = logging.getLogger(config.APP_NAME)
 
     logger.info("Starting HDF5 to DICOM, Retrieving Template DICOMS")
-    dcm_paths = utils.get_files(input_dicom, config.DCM2HD5_INPUT_EXT)
+    dcm_paths = utils.get_files(input_dicom, config.DCM2HD5_INPUT_EXT, recursive)
     dcms = [dcmread(str(path)) for path in dcm_paths]
 
     logger.info("Got %d DICOMS" % len(dcms))
@@ -132,20 +138,74 @@ def hd5_to_dicom(input_hdf5, input_dicom, output_dicom):
         dcm.save_as(os.path.join(output_dicom, dcm_name))
 
 
+def batch_tasks(manifest=None, batch_dir=None, template_dir=None, output_dir=None):
+    """ Build the batch of series to export, either from a manifest with
+    input_hdf5,input_dicom,output_dicom rows or from every HDF5 under batch_dir.
+    Manifest templates are read like the single series arguments, including
+    sub-directories. The templates of an HDF5 named <series>.hd5 are read from
+    template_dir/<series>, without the DICOMs in its sub-directories. Raises a ValueError if series
+    collide or their templates are ambiguous.
+
+    Parameters
+    --------
+    manifest: pathlib.Path
+            Path to the CSV manifest
+    batch_dir: pathlib.Path
+            Path to a directory of HDF5s
+    template_dir: pathlib.Path
+            Path to a directory with a template DICOM directory per series
+    output_dir: str
+            Path to the output directory for batch_dir, with the directory structure of batch_dir
+
+    """
+    if manifest:
+        tasks = [batch.BatchTask(name=in_hdf5, inputs=[in_hdf5, in_dicom], outputs=[out_dicom],
+                                 args=(Path(in_hdf5), Path(in_dicom)), recursive=True)
+                 for in_hdf5, in_dicom, out_dicom in batch.read_manifest(manifest, 3)]
+        batch.check_unique(tasks)
+        return tasks
+
+    tasks = []
+    for hdf5_path in sorted(batch.visible_files(batch_dir, config.HD5_INPUT_EXT)):
+        name = batch.series_name(hdf5_path.with_suffix(''), batch_dir)
+        in_dicom = batch.series_path(template_dir, name)
+        out_dicom = str(Path(output_dir) / name)
+        tasks.append(batch.BatchTask(name=name, inputs=[str(hdf5_path), str(in_dicom)], outputs=[out_dicom],
+                                     args=(hdf5_path, in_dicom), recursive=False))
+    batch.check_unique(tasks)
+    return tasks
+
+
 if __name__ == '__main__':
 
     # Parse Arguments
     parser = argparse.ArgumentParser(description='Extract HD5 data to DICOM using template DICOM', add_help=False)
-    parser.add_argument('--input-hdf5', '-h', required=True, type=utils.existing_path(config.HD5_INPUT_EXT), help='Path to input HD5')
-    parser.add_argument('--input-dicom', '-d', required=True, type=utils.existing_path(config.DCM2HD5_INPUT_EXT), help='Path to the template DICOM directory')
-    parser.add_argument('--output-dicom', '-o', required=True, help='Path to output DICOM directory')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--input-hdf5', '-h', type=utils.existing_path(config.HD5_INPUT_EXT), help='Path to input HD5')
+    parser.add_argument('--input-dicom', '-d', type=utils.existing_path(config.DCM2HD5_INPUT_EXT),
+                        help='Path to the template DICOM directory, or to a directory of them with --batch-dir')
+    parser.add_argument('--output-dicom', '-o', help='Path to output DICOM directory')
+    batch.add_batch_arguments(parser, mode, config.HD5_INPUT_EXT, config.HD52DCM_REPORT_FILE)
     args = parser.parse_args()
 
+    is_batch = args.manifest or args.batch_dir
+    if is_batch and args.batch_dir and not (args.input_dicom and args.output_dir):
+        parser.error('--input-dicom and --output-dir are required with --batch-dir')
+    elif not is_batch and not (args.input_hdf5 and args.input_dicom and args.output_dicom):
+        parser.error('--input-hdf5, --input-dicom and --output-dicom are required outside batch mode')
+
     # App Specific Logger
     logger = utils.init_logger()
 
     # Main app logic
-    hd5_to_dicom(args.input_hdf5, args.input_dicom, args.output_dicom)
+    if is_batch:
+        try:
+            tasks = batch_tasks(args.manifest, args.batch_dir, args.input_dicom, args.output_dir)
+        except ValueError as e:
+            parser.error(str(e))
+        batch.main(hd5_to_dicom, tasks, args)
+    else:
+        hd5_to_dicom(args.input_hdf5, args.input_dicom, args.output_dicom)
 
 
 
@@ -1,7 +1,9 @@
 import collections
 from enum import Enum
 import logging
+import time
 import config
+from job_profiler import JobProfiler, job_gate
 
 
 
@@ -9,6 +11,9 @@ import config
 JobEntry = collections.namedtuple('JobEntry',
                                   'name config preprocess postprocess func')
 
+# A step of a chained job, func is called as func(volume, meta_data, config)
+JobStep = collections.namedtuple('JobStep', 'name config func')
+
 class JobStatus(Enum):
     INVALID = -1
     PENDING=0
@@ -30,6 +35,16 @@ class InferencePipeline:
     >>> pipeline.register(job)
     >>> pipeline.execute('3dblur', '/path/to/input/dicom/folder',
     ....                '/path/to/output/dicom/folder')
+
+    A job's func can also be a list of JobStep objects, chained between a
+    single preprocess and postprocess. The volume is passed between the steps
+    in memory, and a step returning None is taken to have updated it in place:
+
+    >>> job = JobEntry(name='3dblur-twice', config={'sigma': 1.0},
+    ....               preprocess=pre_gaussian_blur3d,
+    ....               postprocess=post_gaussian_blur3d,
+    ....               func=[JobStep('blur', {'sigma': 1.0}, gaussian_blur3d),
+    ....                     JobStep('blur-wide', {'sigma': 2.0}, gaussian_blur3d)])
     '''
 
     def __init__(self, registry: list):
@@ -76,29 +91,127 @@ class InferencePipeline:
         '''
         return job_name in self.job_register
 
-    def execute(self, job_name: str, in_dicom_dir: str, out_dicom_dir: str):
+    def execute(self, job_name: str, in_dicom_dir: str, out_dicom_dir: str, profile: bool = False,
+                sample: bool = False):
         '''Execute a job specified by job_name, with the in_dicom_dir
         (directory containing DICOM files) as input and out_dicom_dir as the
         output DICOM directory.
 
+        When profile is set, the execution is wrapped with cProfile and
+        tracemalloc snapshots are taken at every stage boundary. The results
+        are stored in out_dicom_dir suffixed with config.PROFILE_DIR_SUFFIX.
+        A profiled job waits for the running jobs and runs alone, see JobGate.
+        A sampled job is only profiled if no other job is running, and otherwise
+        runs unprofiled instead of holding back other jobs.
+
         :param job_name: a string, the job's unique name
         :param in_dicom_dir: a string, the path to the input DICOM folder
         :param out_dicom_dir: a string, the path to the output DICOM folder
+        :param profile: a bool, if the execution should be profiled
+        :param sample: a bool, if the execution should be profiled when the pipeline is idle
         '''
 
         job_info = self.job_register[job_name]
-        cur_job = job_info['job']
         job_info['status'] = JobStatus.EXECUTING
         job_info['output'] = out_dicom_dir
+        job_info.pop('profile', None)
+        job_info['timings'] = []
+
+        if profile:
+            with job_gate.exclusive():
+                self._execute_job(job_info, in_dicom_dir, out_dicom_dir, True)
+        elif sample:
+            with job_gate.exclusive_if_idle() as idle:
+                self._execute_job(job_info, in_dicom_dir, out_dicom_dir, idle)
+        else:
+            with job_gate.shared():
+                self._execute_job(job_info, in_dicom_dir, out_dicom_dir, False)
+
+    def _execute_job(self, job_info: dict, in_dicom_dir: str, out_dicom_dir: str, profile: bool):
+        '''Run the stages of a job, recording their timings in job_info.'''
+        cur_job = job_info['job']
+        timings = job_info['timings']
+
+        profiler = None
+        if profile:
+            profiler = self._start_profile(out_dicom_dir)
+
+        stage_start = time.perf_counter()
+
+        def end_stage(stage):
+            nonlocal stage_start
+            timings.append({'stage': stage, 'seconds': time.perf_counter() - stage_start})
+            if profiler:
+                profiler.mark(stage)
+            stage_start = time.perf_counter()
+
         try:
             preproc_out = cur_job.preprocess(in_dicom_dir, cur_job.config)
-            proc_out = cur_job.func(*preproc_out)
+            end_stage('preprocess')
+            if callable(cur_job.func):
+                proc_out = cur_job.func(*preproc_out)
+                end_stage('func')
+            else:
+                proc_out = self._execute_steps(cur_job.func, preproc_out, end_stage)
             cur_job.postprocess(in_dicom_dir, out_dicom_dir, proc_out)
-            job_info['status'] = JobStatus.SUCCESS
+            end_stage('postprocess')
+            status = JobStatus.SUCCESS
         except Exception as e:
-            job_info['status'] = JobStatus.FAILED
+            status = JobStatus.FAILED
             self.logger.exception('Job Execution Failed with error : %s', e)
 
+        # Save the profile first, so it's available as soon as the job is reported done
+        if profiler:
+            self._save_profile(job_info, profiler)
+        job_info['status'] = status
+
+    def _execute_steps(self, steps: list, preproc_out: tuple, end_stage):
+        '''Run the steps of a chained job on the preprocessed volume.
+
+        :param steps: a list of JobStep objects
+        :param preproc_out: the (volume, meta_data, ...) tuple returned by preprocess
+        :param end_stage: called with the step name after every step
+        :return: the volume returned by the last step
+        '''
+        volume, meta_data = preproc_out[0], preproc_out[1]
+        for step in steps:
+            step_out = step.func(volume, meta_data, step.config)
+            if step_out is not None:
+                volume = step_out
+            end_stage(step.name)
+        return volume
+
+    def _start_profile(self, out_dicom_dir: str):
+        '''Start profiling a job, writing to out_dicom_dir suffixed with config.PROFILE_DIR_SUFFIX.
+
+        A profiler failing to start doesn't fail the job, which then runs unprofiled.
+
+        :return: the started JobProfiler, or None
+        '''
+        profiler = JobProfiler(out_dicom_dir + config.PROFILE_DIR_SUFFIX)
+        try:
+            profiler.start()
+            return profiler
+        except Exception as e:
+            self.logger.exception('Starting Job Profile Failed with error : %s', e)
+            return None
+
+    def _save_profile(self, job_info: dict, profiler: JobProfiler):
+        '''Stop the profiler and record where its output was stored.
+
+        A failure to save the profile doesn't change the job status.
+        '''
+        try:
+            profiler.stop()
+            job_info['profile'] = profiler.output_dir
+        except Exception as e:
+            self.logger.exception('Saving Job Profile Failed with error : %s', e)
+
+    def _find_job_info_by_output(self, out_dicom_dir):
+        for job_name, job_info in self.job_register.items():
+            if 'output' in job_info and job_info['output'] == out_dicom_dir:
+                return job_info
+        return None
 
     def find_job_by_output(self, out_dicom_dir):
         '''
@@ -106,7 +219,29 @@ class InferencePipeline:
         :param out_dicom_dir:
         :return:
         '''
-        for job_name, job_info in self.job_register.items():
-            if 'output' in job_info and job_info['output'] == out_dicom_dir:
-                return job_info['status'], job_info['output']
-        return JobStatus.INVALID, None
\ No newline at end of file
+        job_info = self._find_job_info_by_output(out_dicom_dir)
+        if job_info is None:
+            return JobStatus.INVALID, None
+        return job_info['status'], job_info['output']
+
+    def find_profile_by_output(self, out_dicom_dir):
+        '''
+        Find the profile directory of the job with the associated output directory
+        :param out_dicom_dir:
+        :return: the job status and the profile directory, None if it wasn't profiled
+        '''
+        job_info = self._find_job_info_by_output(out_dicom_dir)
+        if job_info is None:
+            return JobStatus.INVALID, None
+        return job_info['status'], job_info.get('profile', None)
+
+    def find_timings_by_output(self, out_dicom_dir):
+        '''
+        Find the stage timings of the job with the associated output directory
+        :param out_dicom_dir:
+        :return: the job status and a list of {'stage', 'seconds'} dicts in execution order
+        '''
+        job_info = self._find_job_info_by_output(out_dicom_dir)
+        if job_info is None:
+            return JobStatus.INVALID, None
+        return job_info['status'], job_info['timings']
@@ -0,0 +1,190 @@
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+import config
+
+
+class JobGate:
+    '''Lets jobs run concurrently, except profiled jobs which run alone.
+
+    tracemalloc traces every thread of the process, so a profiled job waits
+    for the running jobs to finish and holds back new ones until it's done.
+    This keeps other jobs' allocations out of its report, and keeps jobs that
+    aren't profiled from paying the tracing overhead. Waiting profiled jobs go
+    ahead of new unprofiled ones, while sampled jobs only run profiled if the
+    pipeline is idle, see exclusive_if_idle().
+
+    >>> with job_gate.exclusive() if profile else job_gate.shared():
+    ....    ...
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._running = 0
+        self._profiling = False
+        self._profiles_waiting = 0
+
+    @contextlib.contextmanager
+    def shared(self):
+        '''Run an unprofiled job, alongside other unprofiled jobs'''
+        with self._condition:
+            self._condition.wait_for(lambda: not self._profiling and not self._profiles_waiting)
+            self._running += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        '''Run a profiled job, with no other job running'''
+        with self._condition:
+            self._profiles_waiting += 1
+            self._condition.wait_for(lambda: not self._profiling and not self._running)
+            self._profiles_waiting -= 1
+            self._profiling = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._profiling = False
+                self._condition.notify_all()
+
+
+    @contextlib.contextmanager
+    def exclusive_if_idle(self):
+        '''Run a sampled job profiled if no other job is running or waiting to
+        be profiled, or else unprofiled like shared(). Yields if it's profiled.'''
+        with self._condition:
+            idle = not self._profiling and not self._running and not self._profiles_waiting
+            if idle:
+                self._profiling = True
+            else:
+                self._condition.wait_for(lambda: not self._profiling and not self._profiles_waiting)
+                self._running += 1
+        try:
+            yield idle
+        finally:
+            with self._condition:
+                if idle:
+                    self._profiling = False
+                else:
+                    self._running -= 1
+                self._condition.notify_all()
+
+
+# cProfile and tracemalloc are process wide, so the gate is shared by every pipeline
+job_gate = JobGate()
+
+
+class JobProfiler:
+    '''Captures a cProfile run and tracemalloc snapshots for a single job.
+
+    Snapshots are taken at every stage boundary marked with mark(), and the
+    top allocations of each stage are written as a text report next to the
+    .pstats file once the profiler is stopped.
+
+    Profiles only cover the job alone if it runs inside job_gate.exclusive().
+
+    >>> profiler = JobProfiler('/path/to/profile/dir')
+    >>> profiler.start()
+    >>> ...
+    >>> profiler.mark('preprocess')
+    >>> ...
+    >>> profiler.stop()
+    '''
+
+    def __init__(self, output_dir: str):
+        '''Instantiate a JobProfiler writing its results to output_dir.
+
+        :param output_dir: a string, the directory to store the profile in
+        '''
+        self.logger = logging.getLogger(config.APP_NAME)
+        self.output_dir = output_dir
+        self.profile = cProfile.Profile()
+        self.snapshots = []
+        self.started_tracing = False
+
+    def start(self):
+        '''Start profiling and take the initial memory snapshot.
+
+        Tracing is stopped again if profiling can't be started, e.g. when
+        another profiler is already active.
+        '''
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(config.PROFILE_TRACEMALLOC_FRAMES)
+            self.started_tracing = True
+
+        try:
+            self.snapshots = [('start', tracemalloc.take_snapshot())]
+            self.profile.enable()
+        except Exception:
+            if self.started_tracing:
+                tracemalloc.stop()
+                self.started_tracing = False
+            raise
+
+    def mark(self, stage: str):
+        '''Take a memory snapshot at the end of a stage.
+
+        :param stage: a string, the name of the stage that just finished
+        '''
+        self.profile.disable()
+        self.snapshots.append((stage, tracemalloc.take_snapshot()))
+        self.profile.enable()
+
+    def stop(self):
+        '''Stop profiling and write the .pstats file and allocation report.'''
+        self.profile.disable()
+        if self.started_tracing:
+            tracemalloc.stop()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.profile.dump_stats(os.path.join(self.output_dir, config.PROFILE_STATS_FILE))
+
+        with open(os.path.join(self.output_dir, config.PROFILE_ALLOC_FILE), 'w') as report_file:
+            report_file.write(self.allocation_report())
+        self.logger.info('Saved job profile to %s', self.output_dir)
+
+    def allocation_report(self) -> str:
+        '''Format the top allocations of every stage, relative to the previous stage.
+
+        :return: str, the allocation report
+        '''
+        lines = []
+        for (_, prev_snapshot), (stage, snapshot) in zip(self.snapshots, self.snapshots[1:]):
+            lines.append('== %s ==' % (stage,))
+            stats = snapshot.compare_to(prev_snapshot, 'lineno')
+            lines.extend(str(stat) for stat in stats[:config.PROFILE_TOP_ALLOCS])
+            lines.append('')
+        return '\n'.join(lines)
+
+
+def read_stats_summary(profile_dir: str) -> str:
+    '''Render the slowest functions of a saved .pstats file as text.
+
+    :param profile_dir: a string, the directory the profile was saved in
+    :return: str, the summary sorted by cumulative time
+    '''
+    stream = io.StringIO()
+    stats = pstats.Stats(os.path.join(profile_dir, config.PROFILE_STATS_FILE), stream=stream)
+    stats.sort_stats('cumulative').print_stats(config.PROFILE_TOP_FUNCS)
+    return stream.getvalue()
+
+
+def read_profile(profile_dir: str) -> dict:
+    '''Read a saved profile, the slowest functions and the allocation report.
+
+    :param profile_dir: a string, the directory the profile was saved in
+    :return: dict, with 'stats' and 'allocations' as text
+    '''
+    with open(os.path.join(profile_dir, config.PROFILE_ALLOC_FILE)) as report_file:
+        allocations = report_file.read()
+    return {'stats': read_stats_summary(profile_dir), 'allocations': allocations}
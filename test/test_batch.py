@@ -0,0 +1,233 @@
+import unittest
+import unittest.mock
+import argparse
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+import batch
+import config
+import utils
+
+
+def write_outputs(name, out_path, recursive):
+    if name == 'crash':
+        os._exit(1)
+    elif name == 'crash_mid_write':
+        with open(out_path, 'w') as out_file:
+            out_file.write('partial')
+        os._exit(1)
+    elif name == 'error':
+        raise ValueError('Bad series')
+
+    with open(out_path, 'w') as out_file:
+        out_file.write(name)
+
+
+def write_dicom_dir(name, out_dir, recursive):
+    os.mkdir(out_dir)
+    with open(os.path.join(out_dir, '0.dcm'), 'w') as out_file:
+        out_file.write(name)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_task(self, name):
+        in_path = self.root / (name + '.in')
+        in_path.write_text(name)
+        out_path = str(self.root / 'out' / (name + '.out'))
+        return batch.BatchTask(name=name, inputs=[str(in_path)], outputs=[out_path], args=(name,), recursive=False)
+
+    def test_failures_dont_abort_batch(self):
+        tasks = [self.make_task(name) for name in ('a', 'crash', 'b', 'error', 'c')]
+        results = {result['name']: result for result in batch.run_batch(write_outputs, tasks, workers=2)}
+
+        self.assertEqual(len(results), len(tasks))
+        for name in ('a', 'b', 'c'):
+            self.assertEqual(results[name]['status'], 'converted')
+        self.assertEqual(results['crash']['status'], 'failed')
+        self.assertEqual(results['error']['status'], 'failed')
+        self.assertIn('Bad series', results['error']['error'])
+
+    def test_partial_outputs_not_kept(self):
+        task = self.make_task('crash_mid_write')
+
+        # Output of a series dying mid-write never reaches its path, so it's not skipped next time
+        for _ in range(2):
+            result = batch.run_batch(write_outputs, [task], workers=1)[0]
+            self.assertEqual(result['status'], 'failed')
+            self.assertFalse(os.path.exists(task.outputs[0]))
+
+    def test_directory_outputs(self):
+        in_path = self.root / 'a.in'
+        in_path.write_text('a')
+        out_dir = self.root / 'out' / 'a'
+        nested_path = out_dir / 's3' / '0.dcm'
+        nested_path.parent.mkdir(parents=True)
+        nested_path.write_text('s3')
+
+        # Staged output directories are moved in file by file, keeping the nested series output
+        task = batch.BatchTask(name='a', inputs=[str(in_path)], outputs=[str(out_dir)], args=('a',), recursive=False)
+        self.assertEqual(batch.run_batch(write_dicom_dir, [task], workers=1)[0]['status'], 'converted')
+        self.assertEqual((out_dir / '0.dcm').read_text(), 'a')
+        self.assertEqual(nested_path.read_text(), 's3')
+        self.assertEqual(sorted(os.listdir(str(out_dir.parent))), ['a'])
+
+    def test_staged_outputs_not_discovered(self):
+        in_dir = self.root / 'in'
+        for path in (in_dir / 'a' / '0.dcm', in_dir / 'out' / '.a.tmp' / '0.dcm', in_dir / '.b.tmp' / 'b.hd5', in_dir / 'c.hd5'):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(path.name)
+
+        # Staged outputs left behind by a dead worker aren't taken for series
+        self.assertEqual(batch.discover_series(in_dir), [in_dir / 'a'])
+        self.assertEqual(batch.visible_files(in_dir, config.HD5_INPUT_EXT), [in_dir / 'c.hd5'])
+
+    def test_skip_up_to_date(self):
+        tasks = [self.make_task(name) for name in ('a', 'b')]
+        batch.run_batch(write_outputs, tasks, workers=1)
+
+        # Outputs newer than their inputs are skipped
+        results = batch.run_batch(write_outputs, tasks, workers=1)
+        self.assertEqual([result['status'] for result in results], ['skipped', 'skipped'])
+
+        # Touched inputs are converted again
+        future = time.time() + 10
+        os.utime(tasks[0].inputs[0], (future, future))
+        results = {result['name']: result['status'] for result in batch.run_batch(write_outputs, tasks, workers=1)}
+        self.assertEqual(results, {'a': 'converted', 'b': 'skipped'})
+
+    def test_skip_by_checksum(self):
+        tasks = [self.make_task(name) for name in ('a', 'b')]
+        report_path = self.root / 'report.json'
+
+        results = batch.run_batch(write_outputs, tasks, workers=1, use_checksum=True)
+        batch.save_report(results, report_path, 0.0)
+
+        # Only the series with changed content is converted again
+        Path(tasks[1].inputs[0]).write_text('changed')
+        prev_checksums = batch.load_checksums(report_path)
+        results = batch.run_batch(write_outputs, tasks, workers=1, use_checksum=True, prev_checksums=prev_checksums)
+        self.assertEqual({result['name']: result['status'] for result in results}, {'a': 'skipped', 'b': 'converted'})
+
+    def test_nested_series(self):
+        in_dir = self.root / 'in'
+        slices = [in_dir / 'nested' / '0.dcm'] + [in_dir / 'nested' / 's3' / ('%d.dcm' % i) for i in range(3)]
+        for path in slices:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(path.name)
+
+        # A directory and its sub-directory are separate series, each with only its own slices
+        series_dirs = batch.discover_series(in_dir)
+        self.assertEqual(series_dirs, [in_dir / 'nested', in_dir / 'nested' / 's3'])
+        self.assertEqual(len(utils.get_files(series_dirs[0], config.DCM2HD5_INPUT_EXT, False)), 1)
+        self.assertEqual(len(utils.get_files(series_dirs[1], config.DCM2HD5_INPUT_EXT, False)), 3)
+        self.assertEqual(len(utils.get_files(series_dirs[0], config.DCM2HD5_INPUT_EXT)), 4)
+
+        # Changes to the sub-directory series don't make the parent series out of date
+        out_path = str(self.root / 'out' / 'nested.out')
+        task = batch.BatchTask(name='nested', inputs=[str(series_dirs[0])], outputs=[out_path], args=('nested',), recursive=False)
+        batch.run_batch(write_outputs, [task], workers=1)
+        future = time.time() + 10
+        os.utime(str(slices[1]), (future, future))
+        self.assertEqual(batch.run_batch(write_outputs, [task], workers=1)[0]['status'], 'skipped')
+
+    def test_series_names(self):
+        in_dir = self.root / 'in'
+
+        # Names keep the directory structure, so they don't collide and resolve back to their series
+        paths = [in_dir / 'a_b', in_dir / 'a' / 'b', in_dir / 'nested' / 's3', in_dir]
+        names = [batch.series_name(path, in_dir) for path in paths]
+        self.assertEqual(names, ['a_b', 'a/b', 'nested/s3', 'in'])
+        self.assertEqual([batch.series_path(in_dir, name) for name in names], paths)
+
+        # HDF5 outputs named after a series resolve to the series' template directory
+        out_dir = self.root / 'out'
+        hdf5_path = out_dir / (names[2] + config.HD5_INPUT_EXT[0])
+        self.assertEqual(batch.series_path(in_dir, batch.series_name(hdf5_path.with_suffix(''), out_dir)), paths[2])
+
+    def test_series_name_collisions(self):
+        in_dir = self.root / 'in'
+        for path in (in_dir / 'x.dcm', in_dir / 'in' / 'y.dcm'):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(path.name)
+
+        # A series directly in the batch directory and a sub-directory named after it collide
+        names = [batch.series_name(path, in_dir) for path in batch.discover_series(in_dir)]
+        self.assertEqual(names, ['in', 'in'])
+        with self.assertRaises(ValueError):
+            batch.series_path(in_dir, 'in')
+
+        tasks = [batch.BatchTask(name=name, inputs=[], outputs=[str(self.root / 'out' / (name + '.hd5'))], args=(), recursive=False)
+                 for name in names]
+        with self.assertRaises(ValueError):
+            batch.check_unique(tasks)
+
+        # As do different series writing the same output
+        tasks = [batch.BatchTask(name=name, inputs=[], outputs=[str(self.root / 'out.hd5')], args=(), recursive=False) for name in 'ab']
+        with self.assertRaises(ValueError):
+            batch.check_unique(tasks)
+        batch.check_unique([self.make_task('a'), self.make_task('b')])
+
+    def test_workers_argument(self):
+        parser = argparse.ArgumentParser()
+        batch.add_batch_arguments(parser, parser.add_mutually_exclusive_group(), config.DCM2HD5_INPUT_EXT, config.DCM2HD5_REPORT_FILE)
+
+        self.assertEqual(parser.parse_args(['-w', '3']).workers, 3)
+        for value in ('0', '-1', 'many'):
+            with self.assertRaises(SystemExit), unittest.mock.patch('sys.stderr'):
+                parser.parse_args(['-w', value])
+
+    def test_recursive_inputs(self):
+        in_dir = self.root / 'in'
+        slice_path = in_dir / 'sub' / '0.dcm'
+        slice_path.parent.mkdir(parents=True)
+        slice_path.write_text('0')
+        out_path = str(self.root / 'out' / 'in.out')
+
+        # Manifest rows include the DICOMs in sub-directories, like the single series arguments
+        task = batch.BatchTask(name='in', inputs=[str(in_dir)], outputs=[out_path], args=('in',), recursive=True)
+        self.assertEqual(batch.run_batch(write_outputs, [task], workers=1)[0]['status'], 'converted')
+
+        # Discovered series don't
+        task = task._replace(recursive=False)
+        result = batch.run_batch(write_outputs, [task], workers=1)[0]
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('No input files', result['error'])
+
+    def test_input_modes_exclusive(self):
+        manifest_path = self.root / 'manifest.csv'
+        manifest_path.write_text('')
+        parser = argparse.ArgumentParser()
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument('--input-dicom', '-i')
+        batch.add_batch_arguments(parser, mode, config.DCM2HD5_INPUT_EXT, config.DCM2HD5_REPORT_FILE)
+
+        self.assertEqual(parser.parse_args(['-b', str(self.root)]).batch_dir, self.root)
+        for argv in (['-m', str(manifest_path), '-b', str(self.root)], ['-i', str(self.root), '-b', str(self.root)]):
+            with self.assertRaises(SystemExit), unittest.mock.patch('sys.stderr'):
+                parser.parse_args(argv)
+
+    def test_report(self):
+        results = batch.run_batch(write_outputs, [self.make_task('a'), self.make_task('error')], workers=1)
+        report_path = self.root / 'report.json'
+        counts = batch.save_report(results, report_path, 1.5)
+
+        self.assertEqual(counts['converted'], 1)
+        self.assertEqual(counts['failed'], 1)
+        with open(str(report_path)) as report_file:
+            report = json.load(report_file)
+        self.assertEqual([series['name'] for series in report['series']], ['a', 'error'])
+        self.assertTrue(all('seconds' in series for series in report['series']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,14 @@
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import numpy as np
-from inference_pipeline import InferencePipeline, JobEntry
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import config
+from job_profiler import read_profile
+from inference_pipeline import InferencePipeline, JobEntry, JobStep, JobStatus
 
 class TestPipeline(unittest.TestCase):
 
@@ -39,6 +46,163 @@ class TestPipeline(unittest.TestCase):
         self.assertTrue(main_method.called)
         self.assertTrue(postproc_method.called)
 
+    def test_chained_execution(self):
+        pipe = InferencePipeline([])
+        job_name = 'test_chain'
+
+        volume = np.ones((2, 2, 2))
+        meta_data = {'spacing': (1.0, 1.0, 1.0)}
+        preproc_method = MagicMock(return_value=(volume, meta_data, {}))
+        postproc_method = MagicMock()
+
+        def double(in_3d, meta, step_config):
+            return in_3d * step_config['factor']
+
+        def add_inplace(in_3d, meta, step_config):
+            in_3d += step_config['offset']
+
+        steps = [JobStep('double', {'factor': 2.0}, double), JobStep('add', {'offset': 1.0}, add_inplace),
+                 JobStep('triple', {'factor': 3.0}, double)]
+        pipe.register(JobEntry(name=job_name, config={}, preprocess=preproc_method,
+                               postprocess=postproc_method, func=steps))
+        pipe.execute(job_name, 'in-dir', 'out-dir')
+
+        # One preprocess and postprocess, with the volume chained through the steps
+        self.assertEqual(preproc_method.call_count, 1)
+        self.assertEqual(postproc_method.call_count, 1)
+        np.testing.assert_array_equal(postproc_method.call_args[0][2], np.full((2, 2, 2), 9.0))
+
+        status, timings = pipe.find_timings_by_output('out-dir')
+        self.assertEqual(status, JobStatus.SUCCESS)
+        self.assertEqual([timing['stage'] for timing in timings], ['preprocess', 'double', 'add', 'triple', 'postprocess'])
+
+    def test_profiled_execution(self):
+        pipe = InferencePipeline([])
+        job_name = 'test_job'
+
+        job = JobEntry(name=job_name, config={'sigma': 2.0}, preprocess=MagicMock(return_value=(np.zeros((2, 2, 2)),)),
+                       postprocess=MagicMock(), func=MagicMock())
+        pipe.register(job)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_dir = os.path.join(tmp_dir, 'out-dir')
+
+            # Unprofiled runs don't record a profile
+            pipe.execute(job_name, 'in-dir', out_dir)
+            self.assertEqual(pipe.find_profile_by_output(out_dir), (JobStatus.SUCCESS, None))
+            self.assertFalse(os.path.exists(out_dir + config.PROFILE_DIR_SUFFIX))
+
+            # Profiled runs store the stats and an allocation report per stage
+            pipe.execute(job_name, 'in-dir', out_dir, profile=True)
+            status, profile_dir = pipe.find_profile_by_output(out_dir)
+            self.assertEqual(status, JobStatus.SUCCESS)
+            self.assertEqual(profile_dir, out_dir + config.PROFILE_DIR_SUFFIX)
+            self.assertTrue(os.path.isfile(os.path.join(profile_dir, config.PROFILE_STATS_FILE)))
+
+            with open(os.path.join(profile_dir, config.PROFILE_ALLOC_FILE)) as report_file:
+                report = report_file.read()
+            for stage in ('preprocess', 'func', 'postprocess'):
+                self.assertIn('== %s ==' % stage, report)
+            self.assertEqual(read_profile(profile_dir)['allocations'], report)
+
+
+    def test_profile_saved_before_final_status(self):
+        pipe = InferencePipeline([])
+        job_name = 'test_job'
+        pipe.register(JobEntry(name=job_name, config={}, preprocess=MagicMock(return_value=()),
+                               postprocess=MagicMock(), func=MagicMock()))
+
+        # Record if the profile was published when the status was set
+        published = []
+
+        class RecordingInfo(dict):
+            def __setitem__(self, key, value):
+                if key == 'status' and value in (JobStatus.SUCCESS, JobStatus.FAILED):
+                    published.append('profile' in self)
+                super().__setitem__(key, value)
+
+        pipe.job_register[job_name] = RecordingInfo(pipe.job_register[job_name])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pipe.execute(job_name, 'in-dir', os.path.join(tmp_dir, 'out-dir'), profile=True)
+
+        self.assertEqual(published, [True])
+
+    def test_profile_start_failure(self):
+        pipe = InferencePipeline([])
+        job_name = 'test_job'
+        pipe.register(JobEntry(name=job_name, config={}, preprocess=MagicMock(return_value=()),
+                               postprocess=MagicMock(), func=MagicMock()))
+
+        # A profiler failing to start leaves the job to run unprofiled
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_dir = os.path.join(tmp_dir, 'out-dir')
+            with patch('cProfile.Profile.enable', side_effect=ValueError('Another profiler is active')):
+                pipe.execute(job_name, 'in-dir', out_dir, profile=True)
+
+            self.assertEqual(pipe.find_profile_by_output(out_dir), (JobStatus.SUCCESS, None))
+            self.assertFalse(tracemalloc.is_tracing())
+
+    def test_profiled_execution_runs_alone(self):
+        pipe = InferencePipeline([])
+        started, release = threading.Event(), threading.Event()
+
+        def blocking_func(*args):
+            started.set()
+            release.wait(5)
+
+        pipe.register(JobEntry(name='running', config={}, preprocess=MagicMock(return_value=()),
+                               postprocess=MagicMock(), func=blocking_func))
+        profiled_preproc = MagicMock(return_value=())
+        pipe.register(JobEntry(name='profiled', config={}, preprocess=profiled_preproc,
+                               postprocess=MagicMock(), func=MagicMock()))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            running = threading.Thread(target=pipe.execute, args=('running', 'in-dir', os.path.join(tmp_dir, 'a')))
+            profiled = threading.Thread(target=pipe.execute, args=('profiled', 'in-dir', os.path.join(tmp_dir, 'b'), True))
+            running.start()
+            self.assertTrue(started.wait(5))
+
+            # The profiled job waits for the running job to finish
+            profiled.start()
+            time.sleep(0.1)
+            self.assertFalse(profiled_preproc.called)
+
+            release.set()
+            running.join(5)
+            profiled.join(5)
+            self.assertTrue(profiled_preproc.called)
+            self.assertEqual(pipe.find_job_by_output(os.path.join(tmp_dir, 'b'))[0], JobStatus.SUCCESS)
+
+    def test_sampled_execution(self):
+        pipe = InferencePipeline([])
+        started, release = threading.Event(), threading.Event()
+
+        def blocking_func(*args):
+            started.set()
+            release.wait(5)
+
+        pipe.register(JobEntry(name='running', config={}, preprocess=MagicMock(return_value=()),
+                               postprocess=MagicMock(), func=blocking_func))
+        pipe.register(JobEntry(name='sampled', config={}, preprocess=MagicMock(return_value=()),
+                               postprocess=MagicMock(), func=MagicMock()))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Sampled jobs are profiled when nothing else runs
+            idle_dir = os.path.join(tmp_dir, 'idle')
+            pipe.execute('sampled', 'in-dir', idle_dir, sample=True)
+            self.assertEqual(pipe.find_profile_by_output(idle_dir), (JobStatus.SUCCESS, idle_dir + config.PROFILE_DIR_SUFFIX))
+
+            # Alongside a running job, they run right away without a profile
+            running = threading.Thread(target=pipe.execute, args=('running', 'in-dir', os.path.join(tmp_dir, 'a')))
+            running.start()
+            self.assertTrue(started.wait(5))
+            busy_dir = os.path.join(tmp_dir, 'busy')
+            pipe.execute('sampled', 'in-dir', busy_dir, sample=True)
+            self.assertEqual(pipe.find_profile_by_output(busy_dir), (JobStatus.SUCCESS, None))
+
+            release.set()
+            running.join(5)
 
 
 if __name__ == '__main__':
@@ -46,7 +46,25 @@ def existing_path(supported_extn, expects_single_file=False):
 
     return inner_validation
 
-def get_files(path, supported_extn):
+def positive_int(value):
+    """ Positive Integer Check Type for ArgParse.
+
+    Parameters
+    --------
+    value: str
+            The argument value
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected an integer: %s' % (value,))
+
+    if number <= 0:
+        raise argparse.ArgumentTypeError('Expected a positive integer: %s' % (value,))
+
+    return number
+
+def get_files(path, supported_extn, recursive=True):
     """Get all files present in path
 
     Parameters
@@ -55,13 +73,16 @@ def get_files(path, supported_extn):
             Input path
     supported_extn: Collection
             Collection of supported extensions.
+    recursive: bool
+            If sub-directories of path are scanned as well.
 
     """
 
     # If it's a directory, scan for all supported extension and flatten the final list
 
     if path.is_dir():
-        file_list = [list(path.glob('**/*' + extn)) for extn in supported_extn]
+        pattern = '**/*' if recursive else '*'
+        file_list = [list(path.glob(pattern + extn)) for extn in supported_extn]
         file_list = [f for a_list in file_list for f in a_list]
     else:
         file_list = [path]
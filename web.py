@@ -1,6 +1,7 @@
 from aiohttp import web
 import uuid
 from inference_pipeline import InferencePipeline, JobEntry, JobStatus
+from job_profiler import read_profile
 from gaussian_blur3d import pre_gaussian_blur3d, gaussian_blur3d, post_gaussian_blur3d
 import logging
 import config
@@ -18,8 +19,8 @@ def gen_uid(uid_len=5):
     letters = string.ascii_lowercase
     return ''.join(random.choice(letters) for i in range(uid_len))
 
-def execute_job(job_name, in_dir, uid):
-    pipeline.execute(job_name, in_dir, config.WEB_OUTPUT_DIR + uid)
+def execute_job(job_name, in_dir, uid, profile, sample):
+    pipeline.execute(job_name, in_dir, config.WEB_OUTPUT_DIR + uid, profile, sample)
 
 @routes.post('/job')
 async def job(request):
@@ -33,6 +34,11 @@ async def job(request):
 
     job_name = json['job_name']
     in_dir = json['in_dir']
+    profile = json.get('profile', False)
+
+    if not isinstance(profile, bool):
+        return web.json_response({'msg': 'Bad Request: profile must be true or false'}, status=400)
+    sample = not profile and random.random() < config.PROFILE_SAMPLE_RATE
 
     # Validate existence of job
     if not pipeline.is_job_registered(job_name):
@@ -45,7 +51,7 @@ async def job(request):
 
     # Create UID and start job
     uid = gen_uid()
-    event_loop.run_in_executor(pool, execute_job, job_name, in_dir, uid)
+    event_loop.run_in_executor(pool, execute_job, job_name, in_dir, uid, profile, sample)
 
 
     return web.json_response({'uid': uid}, status=201)
@@ -67,7 +73,51 @@ def query(request):
     elif status == JobStatus.FAILED:
         return web.json_response({'msg': 'Job has failed! Contact admin!'}, status=500)
 
-    return web.json_response({'msg': 'Job has completed', 'output_dir' : output_dir}, status=200)
+    _, timings = pipeline.find_timings_by_output(config.WEB_OUTPUT_DIR + uid)
+
+    return web.json_response({'msg': 'Job has completed', 'output_dir' : output_dir, 'timings': timings}, status=200)
+
+
+@routes.get('/profile/{job_uid}')
+async def profile(request):
+    uid = request.match_info.get('job_uid', None)
+
+    if not uid:
+        return web.json_response({'msg': 'Job uid required'}, status=400)
+
+    status, profile_dir = pipeline.find_profile_by_output(config.WEB_OUTPUT_DIR + uid)
+
+    if status == JobStatus.INVALID:
+        return web.json_response({'msg': 'Job not found!'}, status=404)
+    elif status == JobStatus.PENDING or status == JobStatus.EXECUTING:
+        return web.json_response({'msg': 'Job is running'}, status=202)
+    elif not profile_dir:
+        return web.json_response({'msg': 'Job was not profiled'}, status=404)
+
+    # Parsing the stats takes a while, keep it off the event loop
+    job_profile = await event_loop.run_in_executor(pool, read_profile, profile_dir)
+
+    return web.json_response({'msg': 'Job profile', 'profile_dir': profile_dir,
+                              'stats': job_profile['stats'], 'allocations': job_profile['allocations']}, status=200)
+
+
+@routes.get('/profile/{job_uid}/pstats')
+def profile_stats(request):
+    uid = request.match_info.get('job_uid', None)
+
+    if not uid:
+        return web.json_response({'msg': 'Job uid required'}, status=400)
+
+    status, profile_dir = pipeline.find_profile_by_output(config.WEB_OUTPUT_DIR + uid)
+
+    if status == JobStatus.INVALID:
+        return web.json_response({'msg': 'Job not found!'}, status=404)
+    elif status == JobStatus.PENDING or status == JobStatus.EXECUTING:
+        return web.json_response({'msg': 'Job is running'}, status=202)
+    elif not profile_dir:
+        return web.json_response({'msg': 'Job was not profiled'}, status=404)
+
+    return web.FileResponse(Path(profile_dir) / config.PROFILE_STATS_FILE)
 
 
 async def init_app():